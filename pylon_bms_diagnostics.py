@@ -14,14 +14,18 @@ periodically sends out a request frame to trigger the BMS reply.
 Version 0.1.2  2025-01-27  Ulrich Lukas
 """
 import argparse
+import itertools
 import logging
+import selectors
+import socket
+import struct
 import time
 import threading
 import json
 import can
 import paho.mqtt.client as mqtt
-from dataclasses import dataclass, asdict
-from pipyadc.utils import TextScreen
+from collections import deque
+from dataclasses import dataclass, fields
 
 PROGNAME: str = "pylon_bms_diagnostics.py"
 
@@ -32,10 +36,46 @@ MQTT_PORT: int = 1883
 
 # Number of CAN frames belonging to one reply data telegram from the BMS
 N_BMS_REPLY_FRAMES: int = 6
+# CAN IDs of the BMS reply frames. Index is the slot in the frames list
+BMS_REPLY_IDS: tuple = (0x351, 0x355, 0x356, 0x359, 0x35C, 0x35E)
+BMS_REPLY_SLOTS: dict = {can_id: i for i, can_id in enumerate(BMS_REPLY_IDS)}
+# Minimum data length per slot, shorter frames are dropped on receive
+BMS_REPLY_MIN_DLC: tuple = (6, 4, 6, 5, 1, 0)
+# Bitmask of received slots when the telegram is complete
+BMS_REPLY_COMPLETE: int = (1 << N_BMS_REPLY_FRAMES) - 1
 # CAN ID which marks the start of the data telegram sent from the BMS
 ID_BMS_TELEGRAM_START: int = 0x359
+# Bit of the telegram start frame in the bitmask of received slots
+BMS_REPLY_START_BIT: int = 1 << BMS_REPLY_SLOTS[ID_BMS_TELEGRAM_START]
 # CAN ID which is sent by the inverter to poll the BMS (using 8x 0x00 data)
 ID_INVERTER_REQUEST: int = 0x305
+# Little-endian payload layouts of the BMS reply frames
+S_351 = struct.Struct("<Hhh")
+S_355 = struct.Struct("<HH")
+S_356 = struct.Struct("<hhh")
+# Two protection (error) bytes, two alarm (warning) bytes, number of modules
+S_359 = struct.Struct("<4?B")
+# Status flags of CAN ID 0x35C for every possible byte value, in order:
+# charge enable, discharge enable, force charge, force charge low battery,
+# balancing charge request
+STATUS_FLAGS_0x35C = tuple(
+    (bool(b & 1<<7), bool(b & 1<<6), bool(b & 1<<5), bool(b & 1<<4), bool(b & 1<<3))
+    for b in range(256)
+)
+# Raw SocketCAN struct can_frame: ID, DLC, 3 padding bytes, 8 data bytes
+S_CAN_FRAME = struct.Struct("=IB3x8s")
+# Kernel timestamp as struct timespec in the SCM_TIMESTAMPNS control message.
+# python-can enables SO_TIMESTAMPNS on the socket
+S_TIMESPEC = struct.Struct("@ll")
+# Flag bits of the can_id field: extended (29-bit) ID, remote request, error
+CAN_EFF_FLAG: int = 0x80000000
+CAN_RTR_FLAG: int = 0x40000000
+CAN_ERR_FLAG: int = 0x20000000
+# Receive buffer size requested for the CAN socket, avoids drops on bursts
+CAN_RCVBUF_SIZE: int = 1 << 20
+# Not exported by the socket module on all Python versions (Linux values)
+SO_TIMESTAMPNS: int = getattr(socket, "SO_TIMESTAMPNS", 35)
+SO_RCVBUFFORCE: int = getattr(socket, "SO_RCVBUFFORCE", 33)
 
 parser = argparse.ArgumentParser(prog=PROGNAME, description=__doc__)
 parser.add_argument("--poll", type=float, nargs="?", const=1.0,
@@ -54,15 +94,20 @@ parser.add_argument("-ss", "--super-silent", action="store_true",
                     help="Suppress text output. Also suppress warnings")
 
 args = parser.parse_args()
+if args.poll is not None and args.poll < 0.2:
+    parser.error("Poll interval must be larger than 0.2 s")
 
-logger = logging.Logger(PROGNAME)
-logger.setLevel(logging.ERROR if args.super_silent else logging.WARNING)
+logging.basicConfig(level=logging.ERROR if args.super_silent else logging.WARNING)
+logger = logging.getLogger(PROGNAME)
 
-# Double-Buffered Text Output
-screen = TextScreen()
+# Double-Buffered Text Output. Not imported or created when silent
+screen = None
+if not (args.silent or args.super_silent):
+    from pipyadc.utils import TextScreen
+    screen = TextScreen()
 
 
-@dataclass
+@dataclass(slots=True)
 class BmsState:
     """This represents the BMS state as received on the CAN bus"""
     timestamp_last_bms_update: float = 0.0
@@ -89,31 +134,48 @@ class BmsState:
 # Object holding the received BMS state
 state = BmsState()
 
-# Periodically sends inverter request/reply frames to the BMS
-def fn_thread_poll_bms(interval):
-    next_call = time.time()
-    while not threads_stop.is_set():
-        with can.Bus(args.ifname, "socketcan") as bus:
-            msg = can.Message(arbitration_id=ID_INVERTER_REQUEST,
-                              data=b"\x00" * 8,
-                              is_extended_id=False)
-            bus.send(msg)
-        next_call += interval
-        time.sleep(next_call - time.time())
+# BmsState has no instance __dict__ because of slots=True
+BMS_STATE_FIELDS = tuple(f.name for f in fields(BmsState))
+
+# Compact JSON encoding for MQTT payloads
+json_encode = json.JSONEncoder(separators=(",", ":")).encode
+
+# State snapshots to be published, oldest are dropped if the broker stalls
+publish_queue: deque = deque(maxlen=4)
+# Set when publish_queue was filled or when publish_stop was set
+publish_pending = threading.Event()
+# Terminate the publisher thread if this is set
+publish_stop = threading.Event()
+
+# Publishes queued state snapshots, so CAN receive never waits for MQTT
+def fn_thread_publish():
+    while True:
+        publish_pending.wait()
+        publish_pending.clear()
+        if publish_stop.is_set():
+            return
+        while publish_queue:
+            # Retained, so that new subscribers immediately get the last state
+            mqttc.publish(args.topic, json_encode(publish_queue.popleft()),
+                          qos=0, retain=True)
 
 
 # Push state to MQTT broker
+thread_publish = None
 if args.push:
     mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    # Backoff for automatic reconnects of the paho network loop. Messages
+    # pending during broker outages are bounded by publish_queue
+    mqttc.reconnect_delay_set(min_delay=1, max_delay=30)
     mqttc.connect(args.broker, MQTT_PORT, 60)
     # This starts a background thread
     mqttc.loop_start()
+    # Started only once the CAN bus is set up, see below
+    thread_publish = threading.Thread(target=fn_thread_publish)
 
 
-evenrun: bool = False
-def do_text_output():
-    global evenrun
-    screen.put(f"""\n\n\n\n\n
+# Screen layout, fields are filled in from the BmsState object
+format_text_output = """\n\n\n\n\n
     BMS manufacturer string: {state.manufacturer}
     Number of modules: {state.n_modules}
     
@@ -137,100 +199,181 @@ def do_text_output():
     Force Charge: {state.force_charge_request}
     Force Charge Low Battery: {state.force_charge_request_low}
     Balancing Charge Request: {state.balancing_charge_request}
-    {'**********************************************' if evenrun else ''}
-    """)
+    {banner}
+    """.format
+
+# Alternating banner line, shows that the screen is being updated
+next_banner = itertools.cycle(("", "*" * 46)).__next__
+
+def do_text_output():
+    screen.put(format_text_output(state=state, banner=next_banner()))
     if args.push:
         screen.put(f"    MQTT connected: {mqttc.is_connected()}")
     screen.refresh()
-    evenrun = not evenrun
 
 
-def bms_decode(frames):
-    try:
-        # CAN ID 0x351
-        state.v_charge_cmd = 0.1 * int.from_bytes(frames[0x351][0:2], "little")
-        state.i_lim_charge = 0.1 * int.from_bytes(frames[0x351][2:4], "little", signed=True)
-        state.i_lim_discharge = 0.1 * int.from_bytes(frames[0x351][4:6], "little", signed=True)
-        # CAN ID 0x355
-        state.soc = int.from_bytes(frames[0x355][0:2], "little")
-        state.soh = int.from_bytes(frames[0x355][2:4], "little")
-        # CAN ID 0x356
-        state.v_avg = 0.01 * int.from_bytes(frames[0x356][0:2], "little", signed=True)
-        state.i_total = 0.1 * int.from_bytes(frames[0x356][2:4], "little", signed=True)
-        state.t_avg = 0.1 * int.from_bytes(frames[0x356][4:6], "little", signed=True)
-        # CAN ID 0x359
-        state.error_state = bool(frames[0x359][0] or frames[0x359][1])
-        state.warning_state = bool(frames[0x359][2] or frames[0x359][3])
-        state.n_modules = frames[0x359][4]
-        # CAN ID 0x35C
-        state.charge_enable = bool(frames[0x35C][0] & 1<<7)
-        state.discharge_enable = bool(frames[0x35C][0] & 1<<6)
-        state.force_charge_request = bool(frames[0x35C][0] & 1<<5)
-        state.force_charge_request_low = bool(frames[0x35C][0] & 1<<4)
-        state.balancing_charge_request = bool(frames[0x35C][0] & 1<<3)
-        # CAN ID 0x35E
-        state.manufacturer: str = frames[0x35E].decode().rstrip("\x00")
-    # Operator "<=" tests if left set is a subset of the set on the right side
-    #if not {0x351, 0x355, 0x356, 0x359, 0x35C, 0x35E} <= frames.keys():
-    except KeyError as e:
-        logger.warning(f"Incomplete set of data frames received. ID: {hex(e.args[0])}")
+def bms_decode(frames, received, timestamp):
+    if received != BMS_REPLY_COMPLETE:
+        if logger.isEnabledFor(logging.WARNING):
+            missing = [hex(can_id) for i, can_id in enumerate(BMS_REPLY_IDS)
+                       if not received & 1 << i]
+            logger.warning("Incomplete set of data frames received. IDs missing: %s",
+                           missing)
         state.n_invalid_data_telegrams += 1
         return
-    except (IndexError, ValueError, UnicodeDecodeError) as e:
-        logger.warning(f"Invalid data received. Details: {e.args[0]}")
+    f_351, f_355, f_356, f_359, f_35c, f_35e = frames
+    # Frame lengths are checked on receive, only the string can be invalid.
+    # Decode it first so that the state is not left partially updated
+    try:
+        manufacturer = f_35e.decode().rstrip("\x00")
+    except UnicodeDecodeError as e:
+        logger.warning("Invalid data received. Details: %s", e)
         state.n_invalid_data_telegrams += 1
         return
-    state.timestamp_last_bms_update = time.time()
+    # CAN ID 0x351
+    v_charge, i_lim_charge, i_lim_discharge = S_351.unpack_from(f_351)
+    state.v_charge_cmd = 0.1 * v_charge
+    state.i_lim_charge = 0.1 * i_lim_charge
+    state.i_lim_discharge = 0.1 * i_lim_discharge
+    # CAN ID 0x355
+    state.soc, state.soh = S_355.unpack_from(f_355)
+    # CAN ID 0x356
+    v_avg, i_total, t_avg = S_356.unpack_from(f_356)
+    state.v_avg = 0.01 * v_avg
+    state.i_total = 0.1 * i_total
+    state.t_avg = 0.1 * t_avg
+    # CAN ID 0x359
+    error_0, error_1, warning_0, warning_1, state.n_modules = S_359.unpack_from(f_359)
+    state.error_state = error_0 or error_1
+    state.warning_state = warning_0 or warning_1
+    # CAN ID 0x35C
+    (state.charge_enable,
+     state.discharge_enable,
+     state.force_charge_request,
+     state.force_charge_request_low,
+     state.balancing_charge_request) = STATUS_FLAGS_0x35C[f_35c[0]]
+    # CAN ID 0x35E
+    state.manufacturer = manufacturer
+    state.timestamp_last_bms_update = timestamp
     if args.push:
-        # Faster but does not behave as dataclass is intended to behave
-        # mqttc.publish(args.topic, json.dumps(vars(state)))
-        mqttc.publish(args.topic, json.dumps(asdict(state)))
-    if not (args.silent or args.super_silent):
+        # BmsState only has flat fields, no deep copy via asdict() needed
+        publish_queue.append(
+            {name: getattr(state, name) for name in BMS_STATE_FIELDS})
+        publish_pending.set()
+    if screen is not None:
         do_text_output()
 
 
-def receive_data_loop():
-    bms_reply_frames: dict = {}
-    framecounter: int = 0
-    with can.Bus(args.ifname, "socketcan") as bus:
+def kernel_timestamp(ancdata):
+    for level, msg_type, data in ancdata:
+        if level == socket.SOL_SOCKET and msg_type == SO_TIMESTAMPNS:
+            sec, nsec = S_TIMESPEC.unpack_from(data)
+            return sec + 1e-9 * nsec
+    # No timestamp control message, e.g. if the option was not accepted
+    return time.time()
+
+
+def receive_data_loop(bus, poll_interval=None):
+    # Latest frame for each slot of BMS_REPLY_IDS and bitmask of slots
+    # received since the start of the current telegram
+    bms_reply_frames: list = [b""] * N_BMS_REPLY_FRAMES
+    received: int = 0
+    frame_size = S_CAN_FRAME.size
+    ancbufsize = socket.CMSG_SPACE(S_TIMESPEC.size)
+    # If poll_interval is given, inverter request frames are sent periodically
+    # from this loop, scheduled on the monotonic clock via the select timeout
+    poll_msg = can.Message(arbitration_id=ID_INVERTER_REQUEST,
+                           data=b"\x00" * 8,
+                           is_extended_id=False)
+    next_poll = time.monotonic()
+    timeout = None
+    # Wait for readable file descriptors using epoll on Linux.
+    # Raw frames are read from the socket, bypassing can.Message construction.
+    # The bound recvmsg() method is stored as selector key data
+    sel = selectors.DefaultSelector()
+    sel.register(bus.socket, selectors.EVENT_READ, bus.socket.recvmsg)
+    # Bound methods used per frame, avoids repeated attribute lookups
+    select = sel.select
+    unpack_frame = S_CAN_FRAME.unpack
+    get_slot = BMS_REPLY_SLOTS.get
+    try:
         # This is an endless loop reading the CAN bus.
-        for frame in bus:
-            # Fill in BMS reply frames into dictionary
-            bms_reply_frames[frame.arbitration_id] = frame.data
-            # Inverter request or acknowledge is inverleaved with BMS reply.
-            # The inverter frame contains no data and only timestamp is logged
-            if frame.arbitration_id == ID_INVERTER_REQUEST:
-                state.timestamp_last_inverter_request = time.time()
-            elif frame.arbitration_id == ID_BMS_TELEGRAM_START:
-                if framecounter >= N_BMS_REPLY_FRAMES:
-                    bms_decode(bms_reply_frames)
-                framecounter = 1
-            else:
-                framecounter += 1
-
-
-thread_poll_bms = None
-# Terminate running background threads if this is set
-threads_stop = threading.Event()
-
-# If specified on the command line, start sending out request frames periodically
-if args.poll is not None:
-    if args.poll < 0.2:
-        raise argparse.ArgumentError("Poll interval must be larger than 0.2 s")
-    thread_poll_bms = threading.Thread(
-        target=fn_thread_poll_bms,
-        args=(args.poll, )
-        )
-    thread_poll_bms.start()
+        while True:
+            if poll_interval is not None:
+                now = time.monotonic()
+                if now >= next_poll:
+                    # A failed request, e.g. on a full TX queue, is retried
+                    # at the next interval instead of ending the program
+                    try:
+                        bus.send(poll_msg)
+                    except can.CanError as e:
+                        logger.warning("Sending request frame failed. Details: %s", e)
+                    else:
+                        # Own frames are not looped back to the socket
+                        state.timestamp_last_inverter_request = time.time()
+                    next_poll += poll_interval
+                    # On overrun, re-synchronise instead of sending a burst
+                    if next_poll <= now:
+                        next_poll = now + poll_interval
+                timeout = next_poll - now
+            for key, _ in select(timeout):
+                raw, ancdata, _, _ = key.data(frame_size, ancbufsize)
+                can_id, dlc, data = unpack_frame(raw)
+                # The BMS protocol only uses standard 11-bit data frames
+                if can_id & (CAN_EFF_FLAG | CAN_RTR_FLAG | CAN_ERR_FLAG):
+                    continue
+                slot = get_slot(can_id)
+                # Inverter request or acknowledge is inverleaved with BMS reply.
+                # The inverter frame contains no data and only timestamp is logged
+                if can_id == ID_INVERTER_REQUEST:
+                    state.timestamp_last_inverter_request = kernel_timestamp(ancdata)
+                elif slot is not None:
+                    # Start of a new telegram, decode the previous one if its
+                    # start frame was seen, i.e. not when starting mid-telegram
+                    if can_id == ID_BMS_TELEGRAM_START:
+                        if received & BMS_REPLY_START_BIT:
+                            bms_decode(bms_reply_frames, received,
+                                       kernel_timestamp(ancdata))
+                        received = 0
+                    # Fill in BMS reply frames into their slots
+                    if dlc >= BMS_REPLY_MIN_DLC[slot]:
+                        bms_reply_frames[slot] = data[:dlc]
+                        received |= 1 << slot
+                    else:
+                        # Too short to be decoded. Report as invalid data and
+                        # discard the telegram, clearing its start frame bit
+                        # so it is not reported as incomplete as well
+                        logger.warning("Invalid data received. Frame %#x too short: %d bytes",
+                                       can_id, dlc)
+                        state.n_invalid_data_telegrams += 1
+                        received = 0
+    finally:
+        sel.close()
+
+
+def tune_can_socket(sock):
+    # SO_RCVBUFFORCE exceeds rmem_max but needs CAP_NET_ADMIN
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, CAN_RCVBUF_SIZE)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CAN_RCVBUF_SIZE)
+
 
+bus = can.Bus(args.ifname, "socketcan", receive_own_messages=False,
+              ignore_rx_error_frames=True)
+tune_can_socket(bus.socket)
 
 try:
-    receive_data_loop()
+    if thread_publish is not None:
+        thread_publish.start()
+    receive_data_loop(bus, args.poll)
 except KeyboardInterrupt:
     pass
 finally:
+    if thread_publish is not None and thread_publish.is_alive():
+        publish_stop.set()
+        publish_pending.set()
+        thread_publish.join()
     if args.push:
         mqttc.loop_stop()
-    threads_stop.set()
-    if thread_poll_bms is not None:
-        thread_poll_bms.join()
+    bus.shutdown()